@@ -1,14 +1,10 @@
-import copy
-from itertools import combinations, chain
+import heapq
 from numpy.linalg import inv
 import numpy as np
+from scipy.sparse import csr_matrix
 
 from utils import *
 
-import pandas as pd
-
-import networkx as nx
-
 class TMFG:
     def __init__(self):
         pass
@@ -22,20 +18,22 @@ class TMFG:
 
         The method does the following:
 
-        - It sets the instance variable `W` to the input matrix `weights` (a matrix of weights -> squared correlations).
-        - It creates a copy of `weights` and sets it to the instance variable `original_W`.
+        - It sets the instance variable `W` to a C-contiguous float64 NumPy copy of the input matrix `weights` (a matrix of weights -> squared correlations). Both DataFrames and arrays are accepted.
+        - It sets the instance variable `original_W` to a float64 NumPy array of `weights` (`np.asarray` avoids a copy when the input is already float64: the matrix is only read, to select the initial clique and to fill the `P` matrix and the weighted output at full precision).
         - It sets the instance variable `N` to the number of columns in `weights`.
-        - It initializes the instance variable `P` to an NxN matrix of zeros.
-        - It initializes the instance variable `max_clique_gains` to an array of zeros with length (3 * N) - 6.
-        - It initializes the instance variable `best_vertex` to an array of -1s with length (3 * N) - 6.
-        - It initializes the instance variables `cliques`, `separators`, and `triangles` to empty lists.
-        - It initializes the instance variables `vertex_list`, `peo`, and `J` to None.
+        - It initializes the instance variable `max_clique_gains` to an array of zeros with length (2 * N) - 4 (one entry per triangle).
+        - It initializes the instance variable `best_vertex` to an int32 array of -1s with length (2 * N) - 4 (one entry per triangle).
+        - It initializes the instance variable `gain_heap` (a max-heap of the triangle gains, see `__push_gains`) to an empty list.
+        - It initializes the instance variables `cliques` and `separators` to empty lists.
+        - It preallocates the instance variable `triangles` as a (2 * N) - 4 by 3 int32 array (the number of triangles of the final TMFG) and sets the triangle counter `n_tri` to 0.
+        - It initializes the instance variables `vertex_list`, `in_vertex`, `peo`, `P` and `J` to None.
+        - It sets the instance variable `cov` to a float64 NumPy view of the input matrix `cov`.
         
         After this method is called, the instance variables will be set and the model will be ready to compute the Triangulated Maximal Filtered Graph (TMFG).
         '''
 
-        self.W = weights
-        self.original_W = copy.copy(weights)
+        self.W = np.array(weights, dtype=np.float64, order='C')
+        self.original_W = np.asarray(weights, dtype=np.float64)
 
         if output == 'logo':
             self.logo = True
@@ -53,21 +51,33 @@ class TMFG:
             self.weighted_sparse_W_matrix = False
 
         self.N = self.W.shape[1]
-        self.P = np.zeros((self.N, self.N))
-        self.max_clique_gains = np.zeros(((3 * self.N) - 6))
-        self.best_vertex = np.array([-1] * ((3 * self.N) - 6))
+        self.max_clique_gains = np.zeros((2 * self.N) - 4, dtype=np.float64)
+        self.best_vertex = np.full((2 * self.N) - 4, -1, dtype=np.int32)
+        self.gain_heap = []
 
         self.cliques = []
         self.separators = []
-        self.triangles = []
+        self.triangles = np.empty(((2 * self.N) - 4, 3), dtype=np.int32)
+        self.n_tri = 0
 
         self.vertex_list = None
+        self.in_vertex = None
         self.peo = None
+        self.P = None
         self.J = None
-        self.cov = cov
+        self.cov = np.asarray(cov, dtype=np.float64)
 
         self.cliques, self.separators, self.J = self.__compute_TMFG()
 
+    @property
+    def graph(self):
+        '''
+        The `graph` property returns the TMFG as a NetworkX graph built from the `J` matrix. The graph is only built when the property is accessed, so fitting the model never pays for it, and NetworkX is only imported at that point.
+        '''
+        import networkx as nx
+
+        return nx.from_scipy_sparse_array(self.J, create_using=nx.Graph)
+
     def transform(self):
         return self.cliques, self.separators, self.J
 
@@ -82,102 +92,85 @@ class TMFG:
         The method does the following:
 
         - It computes the maximum clique of the input matrix and appends it to the list of cliques.
-        - It creates a list of vertices that are not in the maximum clique and sets it to the `vertex_list` instance variable.
-        - It creates four triangles based on the vertices in the maximum clique and appends them to the `triangles` list.
+        - It creates a boolean mask `in_vertex` flagging the vertices that are not in the maximum clique, and sets the `vertex_list` instance variable to the (sorted) array of their indices.
+        - It creates four triangles based on the vertices in the maximum clique and stores them in the first four rows of the `triangles` array.
         - It sets the `peo` instance variable to a copy of the maximum clique.
         - It sets the main diagonal of the `W` matrix to zeros.
-        - It creates a list of all combinations of two vertices from the maximum clique and sets it to `peo_combinations_list`.
-        - It sets the elements in the `P` matrix to the corresponding elements in the `W` matrix for each combination in `peo_combinations_list`.
-        - It iterates through each triangle in the `triangles` list and computes the best gain and best vertex for each one. It sets the best gain and best vertex for each triangle to the corresponding element in the `max_clique_gains` and `best_vertex` arrays, respectively.
+        - It iterates through each triangle among the first four rows of the `triangles` array and computes the best gain and best vertex for each one. It sets the best gain and best vertex for each triangle to the corresponding element in the `max_clique_gains` and `best_vertex` arrays, respectively, and pushes the gains on `gain_heap`.
         - It iterates through each vertex in the `vertex_list` and performs the following actions:
-            . It selects the triangle with the highest maximum clique gain.
+            . It selects the triangle with the highest maximum clique gain by popping `gain_heap` until it finds an entry that still matches `max_clique_gains` (entries left behind by earlier updates are discarded lazily).
             . It selects the best vertex for that triangle.
             . It adds the best vertex to the `peo` list.
             . It creates a thetraedron with the best vertex and the vertices in the selected triangle.
             . It appends the thetraedron to the `cliques` list.
             . It sets the `newsep` variable to the selected triangle.
-            . It creates a list of all combinations of two vertices from the thetraedron and sets it to `peo_combinations_list`.
-            . It sets the elements in the `P` matrix to the corresponding elements in the `W` matrix for each combination in `peo_combinations_list`.
             . It adds the `newsep` variable to the separators list.
-            . It updates the selected triangle by replacing one of its vertices with the best vertex and adding two new triangles with the remaining two vertices and the best vertex.
-            . It removes the best vertex from the `vertex_list`.
-            . It creates a list of vertices that are not in the `vertex_list` and sets it to `no_vertex_list`.
-            . It finds the indices of the triangles in the `triangles` list that contain the best vertex.
-            . It iterates through each index and performs the following actions:
-                * It computes the best gain and best vertex for the triangle at that index.
-                * It sets the best gain and best vertex for the triangle to the corresponding element in the `max_clique_gains` and `best_vertex` arrays, respectively.
+            . It updates the selected triangle by replacing one of its vertices with the best vertex and writes two new triangles with the remaining two vertices and the best vertex in the next free rows of the `triangles` array.
+            . It clears the best vertex in the `in_vertex` mask and rebuilds `vertex_list` from the mask (a linear scan, with no sorting involved).
+            . It finds (with `np.flatnonzero`, among the `n_tri` triangles created so far) the indices of the triangles whose best vertex was the best vertex just inserted.
+            . It passes these indices to `update_best_gains`, which recomputes the best gain and best vertex of each of those triangles and stores them in the `max_clique_gains` and `best_vertex` arrays.
+            . It does the same for the updated triangle and the two new triangles.
+            . The new gains of all the rescored triangles are pushed on `gain_heap`.
+        - It builds the `P` matrix as a sparse CSR matrix holding, for the six pairs of vertices of every clique, the corresponding element of the `W` matrix.
+        - It builds the output matrix `J` (a sparse CSR matrix) with the helper method selected by `output`.
         '''
 
 
-        self.cliques.append(list(max_clique(self.W)))
-        self.vertex_list = np.setdiff1d(range(self.N), self.cliques[0])
+        self.cliques.append(max_clique(self.original_W).tolist())
+        self.in_vertex = np.ones(self.N, dtype=bool)
+        self.in_vertex[self.cliques[0]] = False
+        self.vertex_list = np.flatnonzero(self.in_vertex)
 
-        self.triangles.append(list(pd.Series(self.cliques[0])[[0, 1, 2]]))
-        self.triangles.append(list(pd.Series(self.cliques[0])[[0, 1, 3]]))
-        self.triangles.append(list(pd.Series(self.cliques[0])[[0, 2, 3]]))
-        self.triangles.append(list(pd.Series(self.cliques[0])[[1, 2, 3]]))
+        c = self.cliques[0]
+        self.triangles[0] = (c[0], c[1], c[2])
+        self.triangles[1] = (c[0], c[1], c[3])
+        self.triangles[2] = (c[0], c[2], c[3])
+        self.triangles[3] = (c[1], c[2], c[3])
+        self.n_tri = 4
 
-        self.peo = copy.copy(self.cliques[0])
-        self.W = np.array(self.W)
+        self.peo = list(self.cliques[0])
         self.W[np.diag_indices_from(self.W)] = 0
 
-        peo_combinations_list = []
-        for n in range(len(self.cliques[0]) + 1):
-            two_d_lists = len(list(combinations(self.cliques[0], n))[0])
-            if two_d_lists == 2:
-                peo_combinations_list += list(combinations(self.cliques[0], n))
-
-        for i in peo_combinations_list:
-            self.P[int(i[0]), int(i[1])] = self.W[int(i[0]), int(i[1])]
-
-        for t in range(0, 4):
-            index_max, max_element = get_best_gain(self.N, self.vertex_list, self.triangles[t], self.W, None)
-            self.max_clique_gains[t] = max_element
-            self.best_vertex[t] = index_max
+        if len(self.vertex_list) > 0:
+            indices = np.arange(4)
+            update_best_gains(self.W, self.vertex_list, self.triangles, indices, self.max_clique_gains, self.best_vertex)
+            self.__push_gains(indices)
 
         for u in range(0, (self.N - 4)):
-            nt = np.argmax(self.max_clique_gains)
-            nv = self.best_vertex[nt]
+            while True:
+                key, nt = heapq.heappop(self.gain_heap)
+                if key == self.__gain_key(self.max_clique_gains[nt]):
+                    break
+            nv = int(self.best_vertex[nt])
             self.peo.append(nv)
 
-            thetraedron = [nv] + self.triangles[nt]
+            newsep = self.triangles[nt].tolist()
+            thetraedron = [nv] + newsep
             self.cliques.append(thetraedron)
-            newsep = self.triangles[nt]
-
-            peo_combinations_list = []
-            thetraedron_tbc = [nv] + newsep
-            for n in range(len(thetraedron_tbc) + 1):
-                two_d_lists = len(list(combinations(thetraedron_tbc, n))[0])
-                if two_d_lists == 2:
-                    peo_combinations_list += list(combinations(thetraedron_tbc, n))
-
-            for i in peo_combinations_list:
-                self.P[int(i[0]), int(i[1])] = self.W[int(i[0]), int(i[1])]
 
             self.separators.append(newsep)
-            self.triangles[nt] = [newsep[0], newsep[1], nv]
-            self.triangles.append([newsep[0], newsep[2], nv])
-            self.triangles.append([newsep[1], newsep[2], nv])
-            self.vertex_list = np.setdiff1d(self.vertex_list, nv)
-
-            no_vertex_list = np.setdiff1d(range(self.N), self.vertex_list)
+            self.triangles[nt] = (newsep[0], newsep[1], nv)
+            self.triangles[self.n_tri] = (newsep[0], newsep[2], nv)
+            self.triangles[self.n_tri + 1] = (newsep[1], newsep[2], nv)
+            self.n_tri += 2
+            self.in_vertex[nv] = False
+            self.vertex_list = np.flatnonzero(self.in_vertex)
 
             if len(self.vertex_list) > 0:
-                indices_of_interest = np.argwhere(self.best_vertex == nv)
-                indices_of_interest = list(chain(*indices_of_interest))
-
-                for t in indices_of_interest:
-                    index_max, max_element = get_best_gain(self.N, self.vertex_list, self.triangles[t], self.W, no_vertex_list)
-                    self.max_clique_gains[t] = max_element
-                    self.best_vertex[t] = index_max
+                indices_of_interest = np.flatnonzero(self.best_vertex[:self.n_tri] == nv)
+                update_best_gains(self.W, self.vertex_list, self.triangles, indices_of_interest, self.max_clique_gains, self.best_vertex)
+                self.__push_gains(indices_of_interest)
 
             self.max_clique_gains[nt] = 0
-            ct = len(self.triangles) - 1
+            ct = self.n_tri - 1
             if len(self.vertex_list) > 0:
-                for t in [nt, (ct - 1), ct]:
-                    index_max, max_element = get_best_gain(self.N, self.vertex_list, self.triangles[t], self.W, no_vertex_list)
-                    self.max_clique_gains[t] = max_element
-                    self.best_vertex[t] = index_max
+                indices = np.array([nt, (ct - 1), ct])
+                update_best_gains(self.W, self.vertex_list, self.triangles, indices, self.max_clique_gains, self.best_vertex)
+                self.__push_gains(indices)
+
+        cliques = np.array(self.cliques, dtype=np.int64)
+        rows, cols = cliques[:, [0, 0, 0, 1, 1, 2]], cliques[:, [1, 2, 3, 2, 3, 3]]
+        self.P = sparse_from_entries(rows, cols, self.original_W[rows, cols], self.N)
 
         if self.logo:
             self.__logo()
@@ -186,41 +179,62 @@ class TMFG:
         else:
             self.__weighted_sparse_W_matrix()
 
-        G = nx.from_numpy_array(self.J)
         return self.cliques, self.separators, self.J
 
+    def __push_gains(self, indices):
+        '''
+        The `__push_gains` method is a helper method of the `TMFG` class that pushes the current gains of the triangles in `indices` on `gain_heap`.
+
+        The heap stores `(-gain, triangle)` pairs (see `__gain_key`), so that its smallest entry is the triangle with the highest gain (ties are resolved in favour of the lowest triangle index, as `np.argmax` would). Entries are never removed when a gain changes: an entry is only considered valid if its gain still equals the one stored in `max_clique_gains`, and stale entries are skipped when popped. This makes both the update and the selection O(log N) instead of scanning all the gains at every step.
+        '''
+        for gain, t in zip(self.max_clique_gains[indices].tolist(), indices.tolist()):
+            heapq.heappush(self.gain_heap, (self.__gain_key(gain), t))
+
+    @staticmethod
+    def __gain_key(gain):
+        '''
+        The `__gain_key` method returns the heap key of a triangle gain: `-gain`, or minus infinity for a NaN gain, so that NaN gains are selected first (as `np.argmax` would do) and can be compared for equality when validating heap entries.
+        '''
+        return -np.inf if np.isnan(gain) else -gain
+
     def __unweighted_sparse_W_matrix(self):
         '''
-        The `__unweighted_sparse_W_matrix` method is a helper method of the `TMFG` class that initializes the instance variable `J` to an NxN matrix of zeros, where `N` is the number of rows in the `original_W` matrix. Then it iterates through the list of cliques and sets the elements in the `J` matrix corresponding to the vertices in each clique to 1. Finally, it sets the main diagonal of the `J` matrix to 0.
+        The `__unweighted_sparse_W_matrix` method is a helper method of the `TMFG` class that sets the instance variable `J` to an NxN sparse CSR matrix. It stacks the cliques into a (K, 4) array, broadcasts it into the (K, 4, 4) positions of all the pairs of vertices in each clique, drops the positions on the main diagonal and sets the elements of `J` at the remaining positions to 1.
 
         This code is creating a matrix representation of the Triangulated Maximal Filtered Graph (TMFG). The resulting `J` matrix will have a value of 1 for each pair of vertices that are connected in the TMFG and a value of 0 for each pair that are disconnected.
         '''
-        self.J = np.zeros((self.original_W.shape[0], self.original_W.shape[0]))
-        for c in self.cliques:
-            self.J[np.ix_(c, c)] = 1
-
-        np.fill_diagonal(self.J, 0)
+        cliques = np.array(self.cliques, dtype=np.int64)
+        rows, cols = np.broadcast_arrays(cliques[:, :, None], cliques[:, None, :])
+        off_diagonal = rows != cols
+        self.J = sparse_from_entries(rows[off_diagonal], cols[off_diagonal], np.ones(off_diagonal.sum()), self.N)
 
     def __weighted_sparse_W_matrix(self):
         '''
-        The `__weighted_sparse_W_matrix` method is a helper method of the `TMFG` class that initializes the instance variable `J` to an NxN matrix of zeros, where `N` is the number of rows in the `original_W` matrix. Then it iterates through the list of cliques and sets the elements in the `J` matrix corresponding to the vertices in each clique to the original similarity value. Finally, it sets the main diagonal of the `J` matrix to 0.
+        The `__weighted_sparse_W_matrix` method is a helper method of the `TMFG` class that sets the instance variable `J` to an NxN sparse CSR matrix. It stacks the cliques into a (K, 4) array, broadcasts it into the (K, 4, 4) positions of all the pairs of vertices in each clique, drops the positions on the main diagonal and sets the elements of `J` at the remaining positions to the original similarity value.
 
         This code is creating a matrix representation of the Triangulated Maximal Filtered Graph (TMFG). The resulting `J` matrix will have a value -1 <= 0 <= 1 for each pair of vertices that are connected in the TMFG and a value of 0 for each pair that are disconnected.
         '''
-        self.J = np.zeros((self.original_W.shape[0], self.original_W.shape[0]))
-        W = self.original_W.to_numpy()
-
-        for c in self.cliques:
-            self.J[np.ix_(c, c)] = W[np.ix_(c, c)]
-
-        np.fill_diagonal(self.J, 0)
+        cliques = np.array(self.cliques, dtype=np.int64)
+        rows, cols = np.broadcast_arrays(cliques[:, :, None], cliques[:, None, :])
+        off_diagonal = rows != cols
+        rows, cols = rows[off_diagonal], cols[off_diagonal]
+        self.J = sparse_from_entries(rows, cols, self.original_W[rows, cols], self.N)
 
     def __logo(self):
-        self.J = np.zeros((self.cov.shape[0], self.cov.shape[0]))
-        C = self.cov.to_numpy()
-
-        for c in self.cliques:
-            self.J[np.ix_(c, c)] += inv(C[np.ix_(c, c)])
+        '''
+        The `__logo` method is a helper method of the `TMFG` class that computes the sparse inverse covariance matrix `J` (LoGo) as an NxN sparse CSR matrix. `J` is the sum of the inverses of the covariance sub-matrices of every clique minus the sum of the inverses of the covariance sub-matrices of every separator.
 
-        for s in self.separators:
-            self.J[np.ix_(s, s)] -= inv(C[np.ix_(s, s)])
+        Since all the cliques are 4x4 and all the separators are 3x3, the sub-matrices are gathered into (K, 4, 4) and (K, 3, 3) stacks and inverted with a single batched call to `inv`. All the resulting entries (the separator ones negated) are then passed at once to `csr_matrix`, which sums the entries that share the same position.
+        '''
+        cliques = np.array(self.cliques, dtype=np.int64)
+        c_rows, c_cols = np.broadcast_arrays(cliques[:, :, None], cliques[:, None, :])
+        c_values = inv(self.cov[c_rows, c_cols])
+
+        separators = np.array(self.separators, dtype=np.int64).reshape(-1, 3)
+        s_rows, s_cols = np.broadcast_arrays(separators[:, :, None], separators[:, None, :])
+        s_values = -inv(self.cov[s_rows, s_cols])
+
+        rows = np.concatenate((c_rows.ravel(), s_rows.ravel()))
+        cols = np.concatenate((c_cols.ravel(), s_cols.ravel()))
+        values = np.concatenate((c_values.ravel(), s_values.ravel()))
+        self.J = csr_matrix((values, (rows, cols)), shape=(self.N, self.N))
@@ -1,4 +1,6 @@
 import numpy as np
+from numba import njit
+from scipy.sparse import csr_matrix
 
 def max_clique(W):
     '''
@@ -6,58 +8,90 @@ def max_clique(W):
 
     The function does the following:
 
-    - It flattens the `W` matrix into a 1D array and sets it to `flat_matrix`.
-    - It calculates the mean of `flat_matrix` and sets it to `mean_flat_matrix`.
-    - It creates an array `v` where each element is the sum of the connections for the corresponding vertex in `W`, considering only connections with a value greater than `mean_flat_matrix`.
-    - It sorts the `v` array in descending order and sets the result to `sorted_v`.
-    - It returns the first four elements of `sorted_v`.
+    - It calculates the mean of all the entries of `W` and sets it to `mean_matrix`.
+    - It creates an array `v` where each element is the sum of the connections for the corresponding vertex in `W`, considering only connections with a value greater than `mean_matrix`.
+    - It selects the four largest elements of `v` with `np.argpartition` (linear time, no full sort) and sets their indices to `top_v`.
+    - It returns `top_v` sorted by decreasing value of `v`.
     
     This function is used to find the maximum clique in the input matrix, which is the clique with the highest sum of connections among its vertices. The returned list will contain the indices of the four vertices with the highest sum of connections.
     '''
 
-    flat_matrix = np.array(W).flatten()
-    mean_flat_matrix = np.mean(flat_matrix)
-    v = np.sum(np.multiply(W, (W > mean_flat_matrix)), axis=1)
-    sorted_v = np.argsort(v)[::-1]
-    return sorted_v[:4]
+    mean_matrix = np.mean(W)
+    v = np.sum(np.multiply(W, (W > mean_matrix)), axis=1)
+    top_v = np.argpartition(v, -4)[-4:]
+    return top_v[np.argsort(v[top_v])[::-1]]
 
 
-def get_best_gain(n, vertex_list, triangle, W, no_vertex_list):
+def sparse_from_entries(rows, cols, values, n):
+    '''
+    The `sparse_from_entries` function takes in the following arguments:
+
+    - `rows`, `cols`: integer arrays (of any, matching, shape) with the positions of the entries.
+    - `values`: an array with the same shape as `rows` and `cols` holding the value of each entry.
+    - `n`: the number of rows and columns of the matrix.
+
+    The function returns an `n` x `n` `scipy.sparse.csr_matrix` whose entry (`rows[k]`, `cols[k]`) is `values[k]`. A position may be listed several times (e.g. an edge shared by several cliques): it is then stored once, with the value of its first occurrence, instead of being summed as `csr_matrix` would do.
+    '''
+    rows, cols, values = np.ravel(rows), np.ravel(cols), np.ravel(values)
+    keys, first = np.unique(rows * n + cols, return_index=True)
+    return csr_matrix((values[first], (keys // n, keys % n)), shape=(n, n))
+
+
+@njit(cache=True)
+def get_best_gain(W, vertex_list, tri0, tri1, tri2):
     '''
     The `get_best_gain` function takes in the following arguments:
 
-    - `n`: an integer representing the number of vertices in the graph.
-    - `vertex_list`: a list of vertices that are currently being considered for addition to the TMFG.
-    - `triangle`: a list of three vertices that are already part of the TMFG.
-    - `W`: the adjacency matrix of the graph.
-    - `no_vertex_list`: a list of vertices that are not currently being considered for addition to the TMFG.
-    
+    - `W`: the adjacency matrix of the graph, as a C-contiguous float64 array.
+    - `vertex_list`: an int64 array of vertices that are currently being considered for addition to the TMFG.
+    - `tri0`, `tri1`, `tri2`: the three vertices of a triangle that is already part of the TMFG.
+
     The function returns the index and value of the vertex in vertex_list that would result in the highest gain when added to the TMFG. The gain is calculated as the sum of the connections between the vertex and the vertices in the triangle.
 
     The function does the following:
 
-        . If `no_vertex_list` is None, it sets it to the list of vertices in the graph that are not in `vertex_list`.
-        . It initializes `gvec` to None.
-        . It iterates through the vertices in triangle and, for each vertex, selects the corresponding column in `W` and sets the elements in the `no_vertex_list` to 0. If `gvec` is None, it sets `gvec` to this modified column. Otherwise, it adds the modified column to `gvec`.
-        . It returns the index and value of the maximum element in `gvec`.
-    
-    This function is used to determine which vertex in `vertex_list` would result in the highest gain when added to the TMFG. The resulting index and value are used to update the `max_clique_gains` and `best_vertex` lists in the `__compute_TMFG` function.
+        . It takes the rows of `W` of the three vertices of the triangle.
+        . If `vertex_list` is empty, it returns -1 and minus infinity (callers are expected to skip the scan in that case).
+        . It initializes `best_vertex` and `best_gain` to the first vertex in `vertex_list` and its gain, so a vertex of `vertex_list` is always returned otherwise.
+        . It iterates through the vertices in `vertex_list` and, for each vertex, sums the three entries of these rows connecting it to the triangle.
+        . If the sum is strictly greater than `best_gain`, it records the vertex and its gain (ties are resolved in favour of the vertex that comes first in `vertex_list`).
+        . As `np.argmax` does, a NaN gain (e.g. from a constant column in the input data) counts as the maximum: the first vertex with a NaN gain is returned straight away.
+        . It returns the best vertex and its gain.
+
+    The function is compiled with Numba, so the scan over `vertex_list` runs as a tight native loop instead of a sequence of NumPy calls. Since `vertex_list` is sorted, reading the three rows of the triangle (rather than one row per candidate) makes the scan walk three contiguous rows of `W` forward, which is friendly to the hardware prefetcher. The resulting index and value are used to update the `max_clique_gains` and `best_vertex` arrays in the `__compute_TMFG` function.
     '''
-    gvec = None
+    if vertex_list.shape[0] == 0:
+        return -1, -np.inf
 
-    if no_vertex_list is None:
-        original_range = range(n)
-        no_vertex_list = np.setdiff1d(original_range, vertex_list)
+    row0, row1, row2 = W[tri0], W[tri1], W[tri2]
+    best_vertex = vertex_list[0]
+    best_gain = row0[best_vertex] + row1[best_vertex] + row2[best_vertex]
 
-    for tr in triangle:
-        column = W[:][tr]
-        column[no_vertex_list] = 0
+    for v in vertex_list:
+        gain = row0[v] + row1[v] + row2[v]
+        if np.isnan(gain):
+            return v, gain
+        if gain > best_gain:
+            best_gain = gain
+            best_vertex = v
 
-        if gvec is None:
-            gvec = column
-        else:
-            gvec = gvec + column
+    return best_vertex, best_gain
 
-    index_max = np.argmax(gvec)
-    max_element = np.max(gvec)
-    return index_max, max_element
\ No newline at end of file
+
+@njit(cache=True)
+def update_best_gains(W, vertex_list, triangles, indices, max_clique_gains, best_vertex):
+    '''
+    The `update_best_gains` function takes in the following arguments:
+
+    - `W`: the adjacency matrix of the graph, as a C-contiguous float64 array.
+    - `vertex_list`: an int64 array of vertices that are currently being considered for addition to the TMFG.
+    - `triangles`: the (T, 3) array of triangles of the TMFG.
+    - `indices`: an array with the indices (rows of `triangles`) of the triangles to be scored.
+    - `max_clique_gains`, `best_vertex`: the arrays holding the best gain and best vertex of each triangle.
+
+    For each index `t` in `indices`, the function calls `get_best_gain` on the triangle `triangles[t]` and writes the result in place into `max_clique_gains[t]` and `best_vertex[t]`. The whole batch is scored inside a single compiled call, so the indices never cross the Python/Numba boundary one at a time.
+    '''
+    for t in indices:
+        index_max, max_element = get_best_gain(W, vertex_list, triangles[t, 0], triangles[t, 1], triangles[t, 2])
+        max_clique_gains[t] = max_element
+        best_vertex[t] = index_max